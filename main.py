@@ -1,191 +1,363 @@
-# main.py
-import socketio
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from fastapi.middleware.cors import CORSMiddleware
-import redis.asyncio as redis
-import json
-from datetime import datetime
-import os
-
-# --- Redis Configuration ---
-REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
-redis_client = None
-
-# --- FastAPI and Socket.IO Setup ---
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], # or specifically ["http://localhost:5173"]
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
-asgi_app = socketio.ASGIApp(socketio_server=sio, other_asgi_app=app)
-
-# --- Redis Functions ---
-async def get_redis_client():
-    """Get Redis client instance"""
-    global redis_client
-    if redis_client is None:
-        redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-    return redis_client
-
-async def store_message(room: str, username: str, message: str):
-    """Store a message in Redis"""
-    try:
-        redis_client = await get_redis_client()
-        message_data = {
-            'username': username,
-            'message': message,
-            'timestamp': datetime.now().isoformat(),
-            'room': room
-        }
-        
-        # Store in room-specific list (limited to last 100 messages)
-        await redis_client.lpush(f"room:{room}:messages", json.dumps(message_data))
-        await redis_client.ltrim(f"room:{room}:messages", 0, 99)
-        
-        # Set expiration for room data (24 hours)
-        await redis_client.expire(f"room:{room}:messages", 86400)
-        
-        return True
-    except Exception as e:
-        print(f"Error storing message in Redis: {e}")
-        return False
-
-async def get_room_history(room: str, limit: int = 50):
-    """Get message history for a room"""
-    try:
-        redis_client = await get_redis_client()
-        messages = await redis_client.lrange(f"room:{room}:messages", 0, limit - 1)
-        
-        # Parse and reverse messages to show oldest first
-        parsed_messages = []
-        for msg in reversed(messages):
-            try:
-                parsed_messages.append(json.loads(msg))
-            except json.JSONDecodeError:
-                continue
-                
-        return parsed_messages
-    except Exception as e:
-        print(f"Error getting room history from Redis: {e}")
-        return []
-
-# --- FastAPI Routes ---
-@app.get("/")
-async def read_root():
-    # Serve the client-side HTML file
-    with open('index.html') as f:
-        return HTMLResponse(content=f.read(), status_code=200)
-
-@app.get("/stats")
-async def get_stats():
-    """
-    A debugging endpoint to see the current state of rooms and clients.
-    """
-    # Get the dictionary of rooms for the default namespace '/'
-    rooms_data = sio.manager.rooms.get('/', {})
-    
-    # We want to filter out the private rooms that Socket.IO creates for each client
-    # (where the room name is the same as the client's SID).
-    active_rooms = {}
-    for room_name, sids in rooms_data.items():
-        # A simple check: if the room name is not a session ID, it's a "real" room.
-        # This works because SIDs are long, random strings.
-        if len(room_name) < 20: 
-            active_rooms[room_name] = list(sids)
-            
-    return {"active_rooms": active_rooms}
-
-@app.get("/api/rooms/{room}/history")
-async def get_room_messages(room: str, limit: int = 50):
-    """API endpoint to get message history for a room"""
-    messages = await get_room_history(room, limit)
-    return {"messages": messages}
-
-# --- Socket.IO Event Handlers ---
-@sio.event
-async def connect(sid, environ, auth):
-    print(f"Client connected: {sid}")
-
-@sio.event
-async def disconnect(sid):
-    print(f"Client disconnected: {sid}")
-
-@sio.on('join')
-async def handle_join(sid, data):
-    room = data.get('room')
-    username = data.get('username', 'Anonymous')
-    if not room:
-        return
-    
-    # Join the room using Socket.IO
-    await sio.enter_room(sid, room)
-    
-    print(f"Client {sid} ({username}) joined room: {room}")
-    
-    # Get room history and send to the joining user
-    room_history = await get_room_history(room)
-    await sio.emit('room_history', {'messages': room_history}, to=sid)
-    
-    # Notify others in the room
-    await sio.emit('user_joined', {'username': username}, room=room, skip_sid=sid)
-    
-    # Confirm join to the user
-    await sio.emit('join_success', {'room': room}, to=sid)
-
-@sio.on('leave')
-async def handle_leave(sid, data):
-    room = data.get('room')
-    if not room:
-        return
-        
-    # Leave the room using Socket.IO
-    await sio.leave_room(sid, room)
-    
-    print(f"Client {sid} left room: {room}")
-    
-    # Notify others in the room
-    await sio.emit('user_left', {'username': 'A user'}, room=room)
-
-@sio.on('message')
-async def handle_message(sid, data):
-    room = data.get('room')
-    message = data.get('message')
-    username = data.get('username')
-    
-    if not room or not message:
-        return
-        
-    print(f"Message from {sid} username=> {username} in room {room}: {message}")
-    
-    # Store message in Redis
-    await store_message(room, username, message)
-    
-    # Send message to ALL OTHER users in the room
-    await sio.emit('new_message', {
-        'sender': username, 
-        'message': message,
-        'timestamp': datetime.now().isoformat()
-    }, room=room, skip_sid=sid)
-
-# --- Startup and Shutdown Events ---
-@app.on_event("startup")
-async def startup_event():
-    """Initialize Redis connection on startup"""
-    try:
-        await get_redis_client()
-        print("Connected to Redis successfully")
-    except Exception as e:
-        print(f"Failed to connect to Redis: {e}")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Close Redis connection on shutdown"""
-    global redis_client
-    if redis_client:
-        await redis_client.close()
-        print("Redis connection closed")
\ No newline at end of file
+# main.py
+import socketio
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+import redis.asyncio as redis
+import msgspec
+import asyncio
+import collections
+import contextlib
+from datetime import datetime
+import logging
+import logging.handlers
+import os
+import queue
+
+# uvloop implements the event loop in C, cutting the per-await overhead
+# that every emit and Redis command pays. Fall back to the stock loop
+# where it is unavailable (e.g. Windows).
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+# --- Logging Setup ---
+# Handlers log through a queue drained by a background thread, so the
+# event loop never blocks on a stdout write. Lazy %s formatting means
+# disabled levels skip argument formatting entirely.
+logger = logging.getLogger('chat')
+_log_queue = queue.Queue(-1)
+_log_listener = None
+
+# --- Redis Configuration ---
+# With USE_REDIS=0 the app runs without Redis entirely: history lives
+# only in the in-process cache and is lost on restart. The choice is
+# resolved once at import so the per-message path carries no branch.
+USE_REDIS = os.getenv('USE_REDIS', '1') == '1'
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+redis_pool = None
+redis_client = None
+
+# Persistence is fire-and-forget: handlers drop encoded messages on this
+# bounded queue and a background task batches them into Redis, so the
+# emit path never waits on a Redis round-trip.
+_write_queue = None
+_writer_task = None
+
+# --- Wire Format ---
+# new_message goes out as a MessagePack binary frame rather than JSON
+# text: smaller on the wire and cheaper to encode, with the Socket.IO
+# fan-out otherwise unchanged. The client decodes it with the matching
+# @msgpack/msgpack library (see index.html).
+_WIRE_ENC = msgspec.msgpack.Encoder()
+
+# --- Room History Cache ---
+# Messages are written once but read back on every join, so keep the
+# already-parsed recent history per room in process. Warm rooms serve
+# joins without touching Redis or decoding anything; Redis remains the
+# source of truth for cold rooms (e.g. after a restart).
+_history_cache = {}
+
+# --- FastAPI and Socket.IO Setup ---
+# orjson serializes JSON responses several times faster than stdlib
+# json, which matters for the up-to-50-message history endpoint.
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"], # or specifically ["http://localhost:5173"]
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+# Compress larger HTTP responses (history payloads can run tens of KB);
+# small ones are passed through untouched.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+asgi_app = socketio.ASGIApp(socketio_server=sio, other_asgi_app=app)
+
+# --- Redis Functions ---
+def store_message(room: str, username: str, message: str, timestamp: str):
+    """Queue a message for the background Redis writer"""
+    # Keep the in-process history current so joins in this room
+    # never have to re-parse the message. Cold rooms are left for
+    # get_room_history to seed from Redis, so older history is not
+    # shadowed by a cache holding only the newest message.
+    cached = _history_cache.get(room)
+    if cached is not None:
+        cached.append({
+            'username': username,
+            'message': message,
+            'timestamp': timestamp,
+            'room': room
+        })
+
+    if _write_queue is None:
+        # Redis never came up at startup; the cache append above is all
+        # the history this process gets.
+        return False
+
+    try:
+        # Stream fields are stored natively, so there is no payload
+        # encoding step; short field names keep the entries small.
+        _write_queue.put_nowait((room, {'u': username, 'm': message, 't': timestamp}))
+        return True
+    except asyncio.QueueFull:
+        # Backpressure: Redis is too far behind, shed the write rather
+        # than stall the broadcast path.
+        logger.warning("Redis write queue full, dropping message for room %s", room)
+        return False
+
+async def _redis_writer():
+    """Drain the write queue and persist messages to Redis in batches"""
+    while True:
+        # Block for the first item, then opportunistically drain up to
+        # 256 more so a burst of messages becomes one pipeline flush.
+        items = [await _write_queue.get()]
+        while len(items) < 256:
+            try:
+                items.append(_write_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        try:
+            # XADD with an approximate MAXLEN trims the stream in O(1)
+            # as part of the write, so no separate LTRIM is needed; one
+            # EXPIRE per distinct room keeps the 24 hour retention. The
+            # whole batch goes out in a single socket write.
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for room, fields in items:
+                    pipe.xadd(f"room:{room}:messages", fields,
+                              maxlen=100, approximate=True)
+                for room in {room for room, _ in items}:
+                    pipe.expire(f"room:{room}:messages", 86400)
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Error storing messages in Redis: %s", e)
+
+def _writer_done(task):
+    """Surface an unexpected writer-task death instead of dying silently"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Redis writer task died: %s", task.exception())
+
+def _cache_message(room: str, username: str, message: str, timestamp: str):
+    """Record a message in the in-process history only (USE_REDIS=0)"""
+    # The cache is the sole store in this mode, so cold rooms are
+    # created here rather than seeded from Redis.
+    _history_cache.setdefault(room, collections.deque(maxlen=100)).append({
+        'username': username,
+        'message': message,
+        'timestamp': timestamp,
+        'room': room
+    })
+    return True
+
+# Resolve the persistence backend once at import; handle_message calls
+# through this name without any per-message branch.
+_persist_message = store_message if USE_REDIS else _cache_message
+
+async def get_room_history(room: str, limit: int = 50):
+    """Get message history for a room"""
+    history = _history_cache.get(room)
+    if history is None:
+        if not USE_REDIS:
+            return []
+        # Cold room: fetch the full retained window from Redis once and
+        # seed the cache so later joins are zero-parse.
+        try:
+            entries = await redis_client.xrevrange(f"room:{room}:messages", count=100)
+        except Exception as e:
+            logger.error("Error getting room history from Redis: %s", e)
+            return []
+
+        # Entries come back newest first as raw field bytes; reverse to
+        # show oldest first. No JSON/msgpack decode step is involved.
+        history = collections.deque(
+            ({'username': fields[b'u'].decode(),
+              'message': fields[b'm'].decode(),
+              'timestamp': fields[b't'].decode(),
+              'room': room}
+             for _, fields in reversed(entries)),
+            maxlen=100)
+        _history_cache[room] = history
+
+    return list(history)[-limit:]
+
+# Read the client page once at import time; re-reading it per request
+# costs a blocking file read on the event loop for a file that never
+# changes in production.
+with open('index.html', 'rb') as f:
+    _INDEX_HTML = f.read()
+
+# --- FastAPI Routes ---
+@app.get("/")
+async def read_root():
+    # Serve the client-side HTML file
+    if os.getenv('DEV'):
+        # Re-read on every request so edits show up without a restart.
+        with open('index.html', 'rb') as f:
+            return HTMLResponse(content=f.read(), status_code=200)
+    return HTMLResponse(content=_INDEX_HTML, status_code=200)
+
+@app.get("/stats")
+async def get_stats():
+    """
+    A debugging endpoint to see the current state of rooms and clients.
+    """
+    # Get the dictionary of rooms for the default namespace '/'
+    rooms_data = sio.manager.rooms.get('/', {})
+
+    # Filter out the private rooms that Socket.IO creates for each client
+    # (where the room name is the same as the client's SID). The manager
+    # keeps every connected SID in the special None room, so checking
+    # membership against that set is exact, unlike the old name-length
+    # heuristic, and an O(1) lookup per room.
+    all_sids = set(rooms_data.get(None, ()))
+    active_rooms = {room_name: list(sids)
+                    for room_name, sids in rooms_data.items()
+                    if room_name is not None and room_name not in all_sids}
+
+    return {"active_rooms": active_rooms}
+
+@app.get("/api/rooms/{room}/history")
+async def get_room_messages(room: str, limit: int = 50):
+    """API endpoint to get message history for a room"""
+    messages = await get_room_history(room, limit)
+    return {"messages": messages}
+
+# --- Socket.IO Event Handlers ---
+@sio.event
+async def connect(sid, environ, auth):
+    logger.info("Client connected: %s", sid)
+
+@sio.event
+async def disconnect(sid):
+    logger.info("Client disconnected: %s", sid)
+
+@sio.on('join')
+async def handle_join(sid, data):
+    room, username = data.get('room'), data.get('username', 'Anonymous')
+    if not room:
+        return
+
+    # Bind the bound method once instead of looking it up per emit.
+    emit = sio.emit
+
+    # Join the room using Socket.IO
+    await sio.enter_room(sid, room)
+
+    logger.info("Client %s (%s) joined room: %s", sid, username, room)
+
+    # Get room history and send to the joining user, msgpack-encoded
+    # like new_message: the largest Socket.IO payload we send shrinks
+    # to a compact binary frame.
+    room_history = await get_room_history(room)
+    await emit('room_history', _WIRE_ENC.encode({'messages': room_history}),
+               to=sid)
+
+    # Notify others in the room
+    await emit('user_joined', {'username': username}, room=room, skip_sid=sid)
+
+    # Confirm join to the user
+    await emit('join_success', {'room': room}, to=sid)
+
+@sio.on('leave')
+async def handle_leave(sid, data):
+    room = data.get('room')
+    if not room:
+        return
+        
+    # Leave the room using Socket.IO
+    await sio.leave_room(sid, room)
+    
+    logger.info("Client %s left room: %s", sid, room)
+    
+    # Notify others in the room
+    await sio.emit('user_left', {'username': 'A user'}, room=room)
+
+@sio.on('message')
+async def handle_message(sid, data):
+    room, message, username = (data.get('room'), data.get('message'),
+                               data.get('username') or 'Anonymous')
+    # Require non-empty strings, not just truthiness: clients can send
+    # any JSON type here, and a bool/dict/list slipping into the stream
+    # fields would make redis-py reject the whole writer batch, taking
+    # other users' co-batched messages down with it.
+    if not (isinstance(room, str) and room and
+            isinstance(message, str) and message):
+        return
+    if not isinstance(username, str):
+        username = str(username)
+
+    logger.info("Message from %s username=> %s in room %s: %s", sid, username, room, message)
+
+    # Format the timestamp once and share it between the stored record
+    # and the broadcast payload, so the two can never disagree.
+    ts = datetime.now().isoformat()
+    payload = {
+        'sender': username,
+        'message': message,
+        'timestamp': ts
+    }
+
+    # Persistence is handed off to the background writer, so the
+    # broadcast never waits on Redis. The emit itself is cheap per
+    # recipient: without a callback, python-socketio encodes the packet
+    # once and reuses the bytes for every member of the room.
+    _persist_message(room, username, message, ts)
+    await sio.emit('new_message', _WIRE_ENC.encode(payload),
+                   room=room, skip_sid=sid)
+
+# --- Startup and Shutdown Events ---
+@app.on_event("startup")
+async def startup_event():
+    """Start the log listener, Redis connection pool and writer task"""
+    global _log_listener, redis_pool, redis_client, _write_queue, _writer_task
+
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+    _log_listener = logging.handlers.QueueListener(
+        _log_queue, logging.StreamHandler())
+    _log_listener.start()
+
+    if not USE_REDIS:
+        logger.info("Running without Redis (USE_REDIS=0); history is in-process only")
+        return
+
+    try:
+        # An explicit pool gives concurrent handlers parallel connections
+        # instead of queueing every command behind a single socket.
+        # decode_responses stays off: the hot path never needs replies
+        # decoded wholesale, and the cold history read decodes just the
+        # stream fields it returns.
+        redis_pool = redis.ConnectionPool.from_url(
+            REDIS_URL, max_connections=32, health_check_interval=30)
+        redis_client = redis.Redis(connection_pool=redis_pool)
+        await redis_client.ping()
+        logger.info("Connected to Redis successfully")
+    except Exception as e:
+        # Leave the queue and writer unstarted; store_message degrades
+        # to cache-only writes instead of feeding a dead writer.
+        logger.error("Failed to connect to Redis: %s", e)
+        return
+
+    _write_queue = asyncio.Queue(maxsize=10_000)
+    _writer_task = asyncio.create_task(_redis_writer())
+    _writer_task.add_done_callback(_writer_done)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the writer task and close Redis connections on shutdown"""
+    if _writer_task:
+        _writer_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _writer_task
+    if redis_client:
+        await redis_client.close()
+    if redis_pool:
+        await redis_pool.disconnect()
+        logger.info("Redis connection closed")
+    if _log_listener:
+        _log_listener.stop()
\ No newline at end of file